@@ -1,19 +1,41 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from pydantic import BaseModel, Field, HttpUrl
 from typing import Optional, Dict
 import uuid
-import shutil
 import os
-from datetime import datetime
+from pathlib import Path
+import asyncio
+import multiprocessing
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
 import xml.etree.ElementTree as ET
 import httpx
+import aiofiles
 
-from exctractv2 import ElementorExtractionAgent
-from transformv2 import ContentTransformationAgent
-from replacev2 import replace_text_and_colors
+from job_store import JobStore
+from pipeline import run_pipeline, SAVE_INTERMEDIATE_JSON
 
+# Uploads are written to disk in 1 MB chunks
+UPLOAD_CHUNK_SIZE = 1 << 20
 
+# Uploads larger than this are rejected while streaming, before they hit the parser
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 16 * 1024 * 1024))
+
+# Pipeline worker processes per uvicorn worker; by default the CPUs are
+# shared out across WEB_CONCURRENCY workers instead of each taking them all
+PIPELINE_WORKERS = int(os.getenv(
+    "PIPELINE_WORKERS",
+    max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", 1)))
+))
+
+# Behind nginx, set this to an internal location aliased to workdir/output/
+# (e.g. "/protected-output/") so nginx sends downloads with kernel sendfile
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX")
 
 class TransformationResponse(BaseModel):
     job_id: str
@@ -28,131 +50,179 @@ class JobStatus(BaseModel):
     output_url: Optional[str] = None
     error: Optional[str] = None
 
+def _format_ns(timestamp_ns: int) -> str:
+    # Naive UTC, so the API keeps its original timestamp format
+    return datetime.fromtimestamp(timestamp_ns / 1e9, timezone.utc).replace(tzinfo=None).isoformat()
+
+def serialize_job(job: Dict) -> Dict:
+    """Format a stored job record's nanosecond timestamps as ISO strings"""
+    data = {k: v for k, v in job.items() if k not in ("created_ns", "completed_ns")}
+    data["created_at"] = _format_ns(job["created_ns"])
+    if "completed_ns" in job:
+        data["completed_at"] = _format_ns(job["completed_ns"])
+    return data
+
+@lru_cache(maxsize=256)
+def _validate_xml_cached(file_path: str, mtime_ns: int, size: int) -> bool:
+    """Parse-check an XML file; mtime and size key the cache to the file contents"""
+    try:
+        # Stream through the document, freeing each element once it closes
+        for _, elem in ET.iterparse(file_path, events=('end',)):
+            elem.clear()
+        return True
+    except ET.ParseError:
+        return False
+
 class ThemeTransformer:
     def __init__(self, api_key: str):
-        self.extraction_agent = ElementorExtractionAgent()
-        self.transformation_agent = ContentTransformationAgent(api_key)
-      
+        self.api_key = api_key
+
+        # CPU-bound pipeline work runs here so the event loop stays responsive
+        self.executor = self._new_executor()
         
-        # Create work directories
-        self.base_dir = "workdir"
-        for dir in ["uploads", "processing", "output"]:
-            os.makedirs(os.path.join(self.base_dir, dir), exist_ok=True)
+        # Create work directories once; per-job paths are built from these
+        self.base_dir = Path("workdir")
+        self.upload_dir = self.base_dir / "uploads"
+        self.processing_dir = self.base_dir / "processing"
+        self.output_dir = self.base_dir / "output"
+        self.cache_dir = self.base_dir / "cache"
+        for dir in [self.upload_dir, self.processing_dir, self.output_dir, self.cache_dir]:
+            dir.mkdir(parents=True, exist_ok=True)
             
-        self.jobs: Dict[str, dict] = {}
+        # Job records live in SQLite so every uvicorn worker sees the same state
+        self.jobs = JobStore(str(self.base_dir / "jobs.db"))
+
+        # Shared HTTP client so webhook calls reuse pooled keep-alive connections
+        self.client = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30)
+        )
 
-    def validate_xml(self, file_path: str) -> bool:
+        # In-flight webhook tasks, referenced here so they aren't garbage collected
+        self._webhook_tasks = set()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        """Start the pipeline worker pool"""
+        # Spawned, not forked: this process already runs threadpool and event
+        # loop threads that a forked child would inherit in an unknown state.
+        return ProcessPoolExecutor(
+            max_workers=PIPELINE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def validate_xml(self, file_path: Path) -> bool:
         """Validate XML file structure"""
-        try:
-            tree = ET.parse(file_path)
-            root = tree.getroot()
-            return True
-        except ET.ParseError:
-            return False
+        stat = os.stat(file_path)
+        return _validate_xml_cached(file_path, stat.st_mtime_ns, stat.st_size)
 
-    async def process_theme(self, job_id: str, input_path: str, style_description: str, webhook_url: Optional[str] = None):
+    async def process_theme(self, job_id: str, input_path: Path, style_description: str, webhook_url: Optional[str] = None):
         """Process theme transformation asynchronously"""
-        work_dir = os.path.join(self.base_dir, "processing", job_id)
+        work_dir = self.processing_dir / job_id
+        output_path = self.output_dir / f"{job_id}.xml"
         
         try:
-            # Update job status
-            self.jobs[job_id]["status"] = "processing"
+            # Update job status; SQLite calls block, so keep them off the event loop
+            await run_in_threadpool(self.jobs.update, job_id, {"status": "processing"})
             
-            # Create job working directory
-            os.makedirs(work_dir, exist_ok=True)
+            # Create job working directory for intermediate artifacts
+            if SAVE_INTERMEDIATE_JSON:
+                work_dir.mkdir(exist_ok=True)
             
             # Validate input XML
-            if not self.validate_xml(input_path):
+            if not await run_in_threadpool(self.validate_xml, input_path):
                 raise ValueError("Invalid input XML file")
             
-            # Extract content
-            rag_path = os.path.join(work_dir, "extracted_content.json")
-            extraction_result = self.extraction_agent.extract_content(input_path, rag_path)
-            
-            if not os.path.exists(rag_path):
-                raise Exception("Content extraction failed")
-            
-            # Transform content
-            transformed_path = os.path.join(work_dir, "transformed_content.json")
-            self.transformation_agent.transform_content(
-                rag_path,
-                transformed_path,
-                style_description
-            )
-            
-            if not os.path.exists(transformed_path):
-                raise Exception("Content transformation failed")
-            
-            # Apply transformations
-            output_path = os.path.join(self.base_dir, "output", f"{job_id}.xml")
-            replace_text_and_colors(
-                input_path,
-                transformed_path,
-                output_path
-            )
+            # Extract, transform and apply in the worker pool
+            loop = asyncio.get_running_loop()
+            executor = self.executor
+            try:
+                await loop.run_in_executor(
+                    executor,
+                    run_pipeline,
+                    self.api_key,
+                    input_path,
+                    work_dir,
+                    output_path,
+                    style_description,
+                    self.cache_dir
+                )
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed) and took the pool with it;
+                # replace it once so later jobs don't all fail the same way
+                if self.executor is executor:
+                    self.executor = self._new_executor()
+                    executor.shutdown(wait=False)
+                raise
             
             # Validate output
-            if not self.validate_xml(output_path):
+            if not await run_in_threadpool(self.validate_xml, output_path):
                 raise Exception("Output XML validation failed")
                 
             # Update job status
-            self.jobs[job_id].update({
+            job = await run_in_threadpool(self.jobs.update, job_id, {
                 "status": "completed",
-                "completed_at": datetime.utcnow().isoformat(),
+                "completed_ns": time.time_ns(),
                 "output_url": f"/download/{job_id}"
             })
             
             # Call webhook if provided
             if webhook_url:
-                await self._call_webhook(webhook_url, self.jobs[job_id])
+                self._schedule_webhook(webhook_url, serialize_job(job))
                 
         except Exception as e:
-            self.jobs[job_id].update({
+            job = await run_in_threadpool(self.jobs.update, job_id, {
                 "status": "failed",
-                "completed_at": datetime.utcnow().isoformat(),
+                "completed_ns": time.time_ns(),
                 "error": str(e)
             })
             if webhook_url:
-                await self._call_webhook(webhook_url, self.jobs[job_id])
+                self._schedule_webhook(webhook_url, serialize_job(job))
             raise
-            
-        finally:
-            # Cleanup processing directory if it exists
-            if os.path.exists(work_dir):
-                try:
-                    shutil.rmtree(work_dir)
-                except Exception as e:
-                    print(f"Failed to cleanup work directory: {e}")
+
+    def _schedule_webhook(self, webhook_url: str, job_data: dict):
+        """Send the webhook in the background so the job slot frees immediately"""
+        task = asyncio.create_task(self._call_webhook(webhook_url, job_data))
+        self._webhook_tasks.add(task)
+        task.add_done_callback(self._webhook_tasks.discard)
 
     async def _call_webhook(self, webhook_url: str, job_data: dict):
         """Call webhook with proper URL validation and error handling"""
         if not webhook_url.startswith(('http://', 'https://')):
             webhook_url = f"https://{webhook_url}"
             
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    webhook_url, 
-                    json=job_data,
-                    timeout=10.0
-                )
-                response.raise_for_status()
-            except httpx.RequestError as e:
-                print(f"Webhook request failed: {e}")
-            except httpx.HTTPStatusError as e:
-                print(f"Webhook HTTP error: {e}")
-            except Exception as e:
-                print(f"Webhook error: {e}")
+        try:
+            response = await self.client.post(webhook_url, json=job_data)
+            response.raise_for_status()
+        except httpx.RequestError as e:
+            print(f"Webhook request failed: {e}")
+        except httpx.HTTPStatusError as e:
+            print(f"Webhook HTTP error: {e}")
+        except Exception as e:
+            print(f"Webhook error: {e}")
 
 app = FastAPI(
     title="Elementor Theme Transformer API",
     description="API for transforming WordPress Elementor themes with AI-powered styling",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Initialize transformer with API key
 transformer = ThemeTransformer(api_key=os.getenv("OPENAI_API_KEY"))
 
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close the shared HTTP client when the app shuts down"""
+    # Let pending webhooks finish before their connections are closed
+    await asyncio.gather(*transformer._webhook_tasks, return_exceptions=True)
+    await transformer.client.aclose()
+
+@app.on_event("shutdown")
+def shutdown_worker_pool():
+    """Stop the pipeline worker processes when the app shuts down"""
+    # Don't block shutdown on running jobs; queued ones are cancelled
+    transformer.executor.shutdown(wait=False, cancel_futures=True)
+
 @app.post("/transform", response_model=TransformationResponse)
 async def transform_theme(
     theme_file: UploadFile = File(...),
@@ -165,29 +235,39 @@ async def transform_theme(
     job_id = str(uuid.uuid4())
     
     try:
-        # Validate file extension
-        if not theme_file.filename.endswith('.xml'):
+        # Validate file extension; the name itself is never used as a path,
+        # uploads are stored under the job id
+        if not (theme_file.filename or "").lower().endswith('.xml'):
             raise HTTPException(status_code=400, detail="Only XML files are supported")
             
         # Save uploaded file
-        input_path = os.path.join(transformer.base_dir, "uploads", f"{job_id}.xml")
+        input_path = transformer.upload_dir / f"{job_id}.xml"
+        total_bytes = 0
         try:
-            with open(input_path, "wb") as buffer:
-                shutil.copyfileobj(theme_file.file, buffer)
+            async with aiofiles.open(input_path, "wb") as buffer:
+                while chunk := await theme_file.read(UPLOAD_CHUNK_SIZE):
+                    total_bytes += len(chunk)
+                    if total_bytes > MAX_UPLOAD_BYTES:
+                        break
+                    await buffer.write(chunk)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Failed to save file: {str(e)}")
         
+        if total_bytes > MAX_UPLOAD_BYTES:
+            os.remove(input_path)
+            raise HTTPException(status_code=413, detail="Uploaded file is too large")
+        
         # Validate XML structure
-        if not transformer.validate_xml(input_path):
+        if not await run_in_threadpool(transformer.validate_xml, input_path):
             os.remove(input_path)
             raise HTTPException(status_code=400, detail="Invalid XML file structure")
         
         # Create job record
-        transformer.jobs[job_id] = {
+        job = await run_in_threadpool(transformer.jobs.create, job_id, {
             "job_id": job_id,
             "status": "queued",
-            "created_at": datetime.utcnow().isoformat()
-        }
+            "created_ns": time.time_ns()
+        })
         
         # Start processing in background
         background_tasks.add_task(
@@ -198,7 +278,7 @@ async def transform_theme(
             webhook_url
         )
         
-        return TransformationResponse(**transformer.jobs[job_id])
+        return TransformationResponse(**serialize_job(job))
         
     except HTTPException:
         raise
@@ -207,37 +287,53 @@ async def transform_theme(
 
 @app.get("/status/{job_id}", response_model=JobStatus)
 async def get_job_status(job_id: str):
-    if job_id not in transformer.jobs:
+    job_data = await run_in_threadpool(transformer.jobs.get, job_id)
+    if job_data is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job_data = transformer.jobs[job_id]
     print("Job Data:", job_data)  # Debugging: Print job data
     
     try:
-        return JobStatus(**job_data)
+        return JobStatus(**serialize_job(job_data))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Invalid job data structure: {str(e)}")
 
 @app.get("/download/{job_id}")
 async def download_transformed_theme(job_id: str):
     """Download transformed theme XML"""
-    if job_id not in transformer.jobs:
+    job = await run_in_threadpool(transformer.jobs.get, job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
         
-    job = transformer.jobs[job_id]
     if job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Job not completed")
         
-    output_path = os.path.join(transformer.base_dir, "output", f"{job_id}.xml")
-    if not os.path.exists(output_path):
+    output_path = transformer.output_dir / f"{job_id}.xml"
+    try:
+        # One stat() serves both the existence check and the response headers
+        stat_result = os.stat(output_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Output file not found")
         
+    filename = f"transformed_theme_{job_id}.xml"
+    if X_ACCEL_REDIRECT_PREFIX:
+        # Hand the body off to nginx; no file bytes pass through Python
+        return Response(
+            media_type="application/xml",
+            headers={
+                "X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PREFIX}{output_path.name}",
+                "Content-Disposition": f'attachment; filename="{filename}"'
+            }
+        )
+        
     return FileResponse(
         output_path,
         media_type="application/xml",
-        filename=f"transformed_theme_{job_id}.xml"
+        filename=filename,
+        stat_result=stat_result
     )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Job state lives in JobStore, so several worker processes can serve requests
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=int(os.getenv("WEB_CONCURRENCY", 1)))
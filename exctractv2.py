@@ -1,10 +1,87 @@
 import os
-import json
+import hashlib
+import orjson
 import xml.etree.ElementTree as ET
+import xml.sax
 import re
-from typing import Dict, List, Any
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from html import unescape
 
+_ANY_TAG_RE = re.compile(r'<[^>]+>')
+_WS_RE = re.compile(r'\s+')
+_HEX_RE = re.compile(r'#(?:[0-9a-fA-F]{3}){1,2}\b')
+
+TEXT_KEYS = frozenset((
+    'title', 'description', 'content', 'text',
+    'heading', 'subtitle', 'caption', 'testimonial_name',
+    'testimonial_job', 'title_text', 'description_text',
+    'editor', 'testimonial_content',
+    'description_text_a', 'tab_title', 'tab_content'
+))
+HTML_TEXT_KEYS = frozenset(('editor', 'testimonial_content', 'tab_content'))
+
+@lru_cache(maxsize=4096)
+def _clean_html(html_content: str) -> str:
+    """Cached HTML cleaning; boilerplate widget text repeats across pages"""
+    text = html_content
+    # Remove HTML tags (including <p> and </p>)
+    if '<' in text:
+        text = _ANY_TAG_RE.sub('', text)
+    # Unescape HTML entities
+    if '&' in text:
+        text = unescape(text)
+    # Normalize whitespace (always, since entities such as &nbsp; unescape
+    # to non-ASCII whitespace)
+    text = _WS_RE.sub(' ', text).strip()
+    return text
+
+class ElementorMetaHandler(xml.sax.handler.ContentHandler):
+    """SAX handler that hands every _elementor_data meta value to a callback"""
+
+    def __init__(self, wp_uri: str, on_elementor_data: Callable[[str], None]):
+        super().__init__()
+        self.wp_uri = wp_uri
+        self.on_elementor_data = on_elementor_data
+        self._buffer = None
+        self._meta_key = None
+        self._meta_value = None
+
+    def startElementNS(self, name, qname, attrs):
+        uri, local_name = name
+        if uri != self.wp_uri:
+            return
+        if local_name == 'postmeta':
+            self._meta_key = None
+            self._meta_value = None
+        elif local_name == 'meta_key':
+            self._buffer = []
+        elif local_name == 'meta_value' and self._meta_key == '_elementor_data':
+            # WordPress writes meta_key first; other postmeta values are
+            # never buffered, so large unrelated blobs aren't held in memory
+            self._buffer = []
+
+    def characters(self, content):
+        if self._buffer is not None:
+            self._buffer.append(content)
+
+    def endElementNS(self, name, qname):
+        uri, local_name = name
+        if uri != self.wp_uri:
+            return
+        if local_name == 'meta_key' and self._buffer is not None:
+            self._meta_key = ''.join(self._buffer)
+            self._buffer = None
+        elif local_name == 'meta_value' and self._buffer is not None:
+            self._meta_value = ''.join(self._buffer)
+            self._buffer = None
+        elif local_name == 'postmeta':
+            if self._meta_key == '_elementor_data' and self._meta_value:
+                self.on_elementor_data(self._meta_value)
+            self._meta_key = None
+            self._meta_value = None
+
 class ElementorExtractionAgent:
     """Agent responsible for extracting content and colors from WordPress XML exports"""
     
@@ -26,107 +103,142 @@ class ElementorExtractionAgent:
             xml_path: Path to WordPress XML export
             rag_output_path: Path to save extracted data
         """
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
+        extracted_data = self.extract_content_data(xml_path)
+
+        # Save to RAG file
+        self._save_to_rag(extracted_data, rag_output_path)
+        print(f"Successfully extracted {len(extracted_data['texts'])} texts and {len(extracted_data['colors'])} colors to {rag_output_path}")
+
+    def extract_content_data(self, xml_path: str, max_workers: Optional[int] = None) -> Dict:
+        """
+        Extract Elementor content and return it without writing to disk
         
+        Args:
+            xml_path: Path to WordPress XML export
+            max_workers: If set, parse and walk pages in a process pool of
+                this size instead of inline while streaming the XML
+        """
+        # 'elementor_data' lists one content hash per page; pages built from the
+        # same template share a single parsed blob in 'elementor_blobs'
         extracted_data = {
             'texts': [],
             'colors': [],
-            'elementor_data': []
+            'elementor_data': [],
+            'elementor_blobs': {}
         }
+        pages = {}
 
-        elementor_metas = root.findall(".//wp:postmeta[wp:meta_key='_elementor_data']", 
-                                     namespaces=self.namespaces)
-
-        for meta in elementor_metas:
-            meta_value = meta.find('wp:meta_value', namespaces=self.namespaces)
-            if meta_value is not None and meta_value.text:
-                try:
-                    elementor_data = json.loads(meta_value.text)
-                    extracted_data['elementor_data'].append(elementor_data)
-                    
-                    texts = self._extract_texts(elementor_data)
-                    extracted_data['texts'].extend(texts)
-                    
-                    colors = self._extract_colors(elementor_data)
-                    extracted_data['colors'].extend(colors)
-                    
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse Elementor data: {e}")
+        def add_page(page_hash: str) -> None:
+            page = pages[page_hash]
+            if page is None:
+                return
+            elementor_data, texts, colors = page
+            extracted_data['elementor_data'].append(page_hash)
+            extracted_data['elementor_blobs'][page_hash] = elementor_data
+            extracted_data['texts'].extend(texts)
+            extracted_data['colors'].extend(colors)
 
-        # Save to RAG file
-        self._save_to_rag(extracted_data, rag_output_path)
-        print(f"Successfully extracted {len(extracted_data['texts'])} texts and {len(extracted_data['colors'])} colors to {rag_output_path}")
+        if max_workers is None:
+            def on_elementor_data(meta_text: str) -> None:
+                page_hash = self._hash_meta(meta_text)
+                if page_hash not in pages:
+                    pages[page_hash] = self._extract_page(meta_text)
+                add_page(page_hash)
+
+            self._scan_elementor_meta(xml_path, on_elementor_data)
+        else:
+            # Pages are independent, so fan the unique ones out once the XML
+            # pass is done
+            page_hashes = []
+            unique_meta = {}
+
+            def on_elementor_data(meta_text: str) -> None:
+                page_hash = self._hash_meta(meta_text)
+                page_hashes.append(page_hash)
+                unique_meta.setdefault(page_hash, meta_text)
+
+            self._scan_elementor_meta(xml_path, on_elementor_data)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(self._extract_page, unique_meta.values(), chunksize=16)
+                pages.update(zip(unique_meta, results))
+            for page_hash in page_hashes:
+                add_page(page_hash)
+
+        return extracted_data
+
+    def _scan_elementor_meta(self, xml_path: str, on_elementor_data: Callable[[str], None]) -> None:
+        """Stream the export with SAX so only the current meta value is buffered"""
+        parser = xml.sax.make_parser()
+        parser.setFeature(xml.sax.handler.feature_namespaces, True)
+        parser.setContentHandler(
+            ElementorMetaHandler(self.namespaces['wp'], on_elementor_data)
+        )
+        parser.parse(xml_path)
+
+    @staticmethod
+    def _hash_meta(meta_text: str) -> str:
+        return hashlib.blake2b(meta_text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _extract_page(self, meta_text: str) -> Optional[Tuple[Any, List[str], List[str]]]:
+        """Parse one _elementor_data value and extract its texts and colors"""
+        try:
+            elementor_data = orjson.loads(meta_text)
+        except orjson.JSONDecodeError as e:
+            print(f"Failed to parse Elementor data: {e}")
+            return None
+        texts, colors = self._extract_texts_and_colors(elementor_data)
+        return elementor_data, texts, colors
 
     def _clean_html_content(self, html_content: str) -> str:
         """Clean HTML content by removing tags and normalizing whitespace"""
-        # Remove <p> and </p> tags
-        text = re.sub(r'</?p>', '', html_content)
-        # Remove any other HTML tags
-        text = re.sub(r'<[^>]+>', '', text)
-        # Unescape HTML entities
-        text = unescape(text)
-        # Normalize whitespace
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text
+        return _clean_html(html_content)
 
-    def _extract_texts(self, data: Any) -> List[str]:
-        """Extract text content from Elementor data"""
+    def _extract_texts_and_colors(self, data: Any) -> Tuple[List[str], List[str]]:
+        """Extract text content and color codes from Elementor data in one walk"""
         texts = []
+        colors = []
+        # Explicit stack instead of recursion; children are pushed in reverse
+        # so texts still come out in document (pre-order) order
+        stack = [data]
+        # Bind hot lookups to locals once; the loop runs for every node
+        pop, push_all = stack.pop, stack.extend
+        add_text = texts.append
+        add_colors = colors.extend
+        find_colors = _HEX_RE.findall
+        clean_html = _clean_html
+        collapse_ws = _WS_RE.sub
         
-        def extract_recursive(item):
-            if isinstance(item, dict):
-                text_keys = [
-                    'title', 'description', 'content', 'text',
-                    'heading', 'subtitle', 'caption', 'testimonial_name',
-                    'testimonial_job', 'title_text', 'description_text',
-                    'editor', 'testimonial_content', 'content',
-                    'description_text_a', 'tab_title', 'tab_content'
-                ]
-                
-                for key in text_keys:
-                    if key in item and isinstance(item[key], str):
+        while stack:
+            item = pop()
+            if type(item) is dict:
+                children = []
+                for key, value in item.items():
+                    value_type = type(value)
+                    if value_type is str:
+                        if '#' in value:
+                            add_colors(find_colors(value))
+                        if not value or key not in TEXT_KEYS:
+                            continue
                         cleaned_text = (
-                            self._clean_html_content(item[key]) 
-                            if key in ['editor', 'testimonial_content', 'tab_content'] 
-                            else re.sub(r'\s+', ' ', item[key]).strip()
+                            clean_html(value)
+                            if key in HTML_TEXT_KEYS
+                            else collapse_ws(' ', value).strip()
                         )
-                        if cleaned_text and len(cleaned_text) > 3:
-                            texts.append(cleaned_text)
+                        if len(cleaned_text) > 3:
+                            add_text(cleaned_text)
+                    elif value_type is dict or value_type is list:
+                        children.append(value)
                 
-                for value in item.values():
-                    if isinstance(value, (dict, list)):
-                        extract_recursive(value)
+                push_all(reversed(children))
             
-            elif isinstance(item, list):
-                for element in item:
-                    extract_recursive(element)
+            elif type(item) is list:
+                push_all(reversed(item))
 
-        extract_recursive(data)
-        return texts
-
-    def _extract_colors(self, data: Any) -> List[str]:
-        """Extract color codes from Elementor data"""
-        colors = []
-        
-        def extract_recursive(item):
-            if isinstance(item, dict):
-                for key, value in item.items():
-                    if isinstance(value, str):
-                        hex_matches = re.findall(r'#(?:[0-9a-fA-F]{3}){1,2}\b', value)
-                        colors.extend(hex_matches)
-                    elif isinstance(value, (dict, list)):
-                        extract_recursive(value)
-            elif isinstance(item, list):
-                for element in item:
-                    extract_recursive(element)
-
-        extract_recursive(data)
-        return colors
+        return texts, colors
 
     def _save_to_rag(self, data: Dict, output_path: str) -> None:
         """Save extracted data to RAG storage file"""
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
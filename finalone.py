@@ -1,57 +1,113 @@
 # loads genai API Key from .env file
 
+from collections import OrderedDict, deque  # answer cache, session history
 import google.generativeai as genai  # Gemini API key
-import io  # file conversions
+import io  # in-memory audio export
+import logging  # debug output
 import os  # system import
 from PIL import Image  # file conversions
 import streamlit as st  # build up website
+import threading  # answer cache lock
+from streamlit.runtime.uploaded_file_manager import UploadedFile  # upload cache key
 from audiorecorder import audiorecorder  # new audio recorder
 import toml  # for reading env keys
 
-def gemini_answer(prompt, img=None):
-    # Sends response
+# Debug messages are dropped unless LOG_LEVEL=DEBUG is set
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(os.environ.get("LOG_LEVEL", "WARNING").upper())
+
+ANSWER_CACHE_SIZE = 256
+# Largest image side worth decoding; Gemini downsizes bigger images anyway
+MAX_IMAGE_SIDE = 2048
+# Decoded images kept by stImg_convert before the oldest are evicted
+IMAGE_CACHE_SIZE = 32
+
+@st.cache_resource
+def get_model(model_name):
+    '''
+    One GenerativeModel per model name, reused across sessions and toggles
+    '''
+    return genai.GenerativeModel(model_name)
+
+@st.cache_resource
+def get_answer_cache():
+    '''
+    Answers shared by every session, keyed by model, prompt and upload id.
+    Sessions run in separate threads, so the lock guards every access
+    '''
+    return OrderedDict(), threading.Lock()
+
+def gemini_answer(prompt, img=None, img_id=None):
+    '''
+    Sends the prompt and yields the response text as it streams in
+    '''
     if prompt == '':
-        return None
+        return
+    model = st.session_state.model
+    cache, lock = get_answer_cache()
+    key = (model.model_name, prompt, img_id)
+    with lock:
+        answer = cache.get(key)
+        if answer is not None:
+            cache.move_to_end(key)
+    if answer is not None:
+        yield answer
+        return
     if img:
-        response = st.session_state.model.generate_content([prompt, img])
+        response = model.generate_content([prompt, img], stream=True)
     else:
-        response = st.session_state.model.generate_content(prompt)
+        response = model.generate_content(prompt, stream=True)
+    chunks = []
     try:
-        return response.text
+        for chunk in response:
+            chunks.append(chunk.text)
+            yield chunk.text
     except ValueError:
-        return 'Please rephrase your prompt to a more appropriate inquiry.'
-
+        yield 'Please rephrase your prompt to a more appropriate inquiry.'
+        return
+    with lock:
+        cache[key] = ''.join(chunks)
+        # Drop the least recently used answer once the cache is full
+        if len(cache) > ANSWER_CACHE_SIZE:
+            cache.popitem(last=False)
+
+@st.cache_resource(max_entries=IMAGE_CACHE_SIZE, hash_funcs={UploadedFile: lambda f: f.file_id})
 def stImg_convert(st_img):
     '''
     Converts the image returned from streamlit's format into
     another format readable by Gemini Pro Vision: pil
+    Decoded once per upload; reruns reuse the same cached object,
+    so callers must treat it as read-only
     '''
-    image_data = st_img.read()
-    # converts streamlit image to pil image
-    pil_image = Image.open(io.BytesIO(image_data))
+    # UploadedFile is already file-like, so PIL can read it without a copy
+    pil_image = Image.open(st_img)
+    # JPEGs can decode at a reduced DCT scale that still covers MAX_IMAGE_SIDE
+    pil_image.draft('RGB', (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    pil_image.load()
     return pil_image
 
 def answer_output(answer):
     '''
-    Shows Gemini response in the output text area
+    Streams Gemini response chunks to the page and returns the full text
     '''
-    print(f"AI Answer: {answer}")
-    st.session_state.answer = answer
     st.markdown('<p class="big-font">Gemini Answer</p>',
                 unsafe_allow_html=True)
-    st.text_area(label='Gemini Answer:', label_visibility='collapsed', value=st.session_state.answer,
-                 height=250, key='answer_output')
+    st.session_state.answer = st.write_stream(answer)
+    log.debug("AI Answer: %s", st.session_state.answer)
     st.divider()
+    return st.session_state.answer
 
 def save_history(prompt, answer):
     '''
     Saves prompt and response to session_state.history
     '''
-    st.session_state.history = f'Question: {prompt}\n\nAnswer: {answer}\n\n{"-"*100}\n\n{st.session_state.history}'
+    # Newest turn first; the text is only joined for display
+    st.session_state.history.appendleft(f'Question: {prompt}\n\nAnswer: {answer}\n\n{"-"*100}\n\n')
     st.markdown('<p class="big-font">Session history</p>',
                 unsafe_allow_html=True)
     st.text_area(label="Session history", label_visibility='collapsed', height=400,
-                 value=st.session_state.history, key='history_text_area')
+                 value=''.join(st.session_state.history), key='history_text_area')
 
 def submit_history():
     '''
@@ -65,33 +121,37 @@ def configure_gemini():
     google_api_key = os.environ.get("GOOGLE_API_KEY")
      
     # Configure Gemini model
-    st.session_state.model = genai.GenerativeModel("gemini-pro")
+    st.session_state.model = get_model("gemini-pro")
+    st.session_state.model_name = "gemini-pro"
     
     if google_api_key:
         genai.configure(api_key=google_api_key)
-        print("Gemini Configured")
+        log.debug("Gemini Configured")
     else:
-        print("API key not found")
+        log.warning("API key not found")
 
 def img_exists(img):
     '''
     Change the Gemini model by determining if 
     there is an img inserted or not.
     '''
+    model_name = "gemini-1.5-flash" if img else "gemini-pro"
+    # Nothing to do when the active model already matches
+    if st.session_state.get('model_name') == model_name:
+        return
+    st.session_state.model = get_model(model_name)
+    st.session_state.model_name = model_name
     if img:
-        st.session_state.model = genai.GenerativeModel("gemini-1.5-flash")
-        print("-- Gemini-Pro-Vision Enabled")
-    elif not img:
-        st.session_state.model = genai.GenerativeModel("gemini-pro")
-        print("-- Gemini-Pro Enabled")
-
-def send_to_Gemini(prompt, pil_img=None):
-    print('AI Response Processing Started')
+        log.debug("-- Gemini-Pro-Vision Enabled")
+    else:
+        log.debug("-- Gemini-Pro Enabled")
+
+def send_to_Gemini(prompt, pil_img=None, img_id=None):
+    log.debug('AI Response Processing Started')
     if pil_img:
-        answer = gemini_answer(prompt=prompt, img=pil_img)
+        answer = answer_output(answer=gemini_answer(prompt=prompt, img=pil_img, img_id=img_id))
     else:
-        answer = gemini_answer(prompt=prompt)
-    answer_output(answer=answer)
+        answer = answer_output(answer=gemini_answer(prompt=prompt))
     save_history(prompt=prompt, answer=answer)
     # Reset prompt and response
     st.session_state.prompt = ''
@@ -121,7 +181,7 @@ def st_start():
     if 'prompt' not in st.session_state:
         st.session_state.prompt = ''
     if 'history' not in st.session_state:
-        st.session_state.history = ''
+        st.session_state.history = deque()
     if 'answer' not in st.session_state:
         st.session_state.answer = ''
 
@@ -133,11 +193,11 @@ def st_start():
     audio = audiorecorder("Click to record", "Click to stop recording")
 
     if len(audio) > 0:
-        # Play the recorded audio
-        st.audio(audio.export().read())  
-
-        # Save the audio file as "audio.wav"
-        audio.export("audio.wav", format="wav")
+        # Play the recorded audio, encoded once in memory (no audio.wav on disk)
+        wav = io.BytesIO()
+        audio.export(wav, format="wav")
+        st.session_state.audio = wav.getvalue()
+        st.audio(st.session_state.audio, format="audio/wav")
         
         # Set the audio file as the prompt (for simplicity)
         st.session_state.prompt = "Audio question has been recorded."
@@ -155,11 +215,13 @@ def st_start():
     prompt = st.session_state.prompt or st.session_state.widget
 
     if len(prompt):
+        # Pick the vision model only when an image is attached
+        img_exists(img)
         # Check if an image is uploaded, use it if available
         if img:
             pil_image = stImg_convert(img)
             with st.spinner('Running...'):
-                send_to_Gemini(prompt=prompt, pil_img=pil_image)
+                send_to_Gemini(prompt=prompt, pil_img=pil_image, img_id=img.file_id)
         else:
             with st.spinner('Running...'):
                 send_to_Gemini(prompt=prompt)
@@ -0,0 +1,58 @@
+import orjson
+import sqlite3
+from contextlib import closing
+from typing import Dict, Optional
+
+class JobStore:
+    """SQLite-backed job records shared by every app worker process"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with closing(self._connect()) as conn:
+            # WAL lets status polls read while a job record is being written
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data BLOB NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def create(self, job_id: str, data: Dict) -> Dict:
+        """Insert a new job record"""
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, data) VALUES (?, ?)",
+                (job_id, orjson.dumps(data))
+            )
+        return data
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Return the job record, or None if the job is unknown"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT data FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def update(self, job_id: str, fields: Dict) -> Dict:
+        """Merge fields into an existing job record and return the result"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT data FROM jobs WHERE job_id = ?", (job_id,)
+                ).fetchone()
+                if row is None:
+                    raise KeyError(job_id)
+                data = orjson.loads(row[0])
+                data.update(fields)
+                conn.execute(
+                    "UPDATE jobs SET data = ? WHERE job_id = ?",
+                    (orjson.dumps(data), job_id)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return data
@@ -0,0 +1,87 @@
+import os
+import time
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional
+
+import orjson
+
+from exctractv2 import ElementorExtractionAgent
+from transformv2 import ContentTransformationAgent
+from replacev2 import replace_text_and_colors_data
+
+# Set SAVE_INTERMEDIATE_JSON=1 to keep each job's extracted/transformed JSON for debugging
+SAVE_INTERMEDIATE_JSON = os.getenv("SAVE_INTERMEDIATE_JSON") == "1"
+
+# Cached LLM transformations older than this many seconds are regenerated
+TRANSFORM_CACHE_TTL = int(os.getenv("TRANSFORM_CACHE_TTL", 7 * 24 * 3600))
+
+def run_pipeline(api_key: str, input_path: Path, work_dir: Path, output_path: Path, style_description: str, cache_dir: Path) -> None:
+    """Run extract -> transform -> replace for one job inside a worker process"""
+    extraction_agent = ElementorExtractionAgent()
+    # Reuse GPT responses for unchanged text batches across themes and runs
+    transformation_agent = ContentTransformationAgent(
+        api_key,
+        cache_dir=str(cache_dir / "responses"),
+        cache_ttl=TRANSFORM_CACHE_TTL
+    )
+
+    # Stages hand their results over in memory instead of via JSON files
+    extracted_content = extraction_agent.extract_content_data(input_path)
+    
+    # Identical theme content + style reuses the previous LLM result
+    cache_path = cache_dir / f"{_transform_cache_key(extracted_content, style_description)}.json"
+    transformed_content = _load_cached_transform(cache_path)
+    if transformed_content is None:
+        transformed_content = transformation_agent.transform_content_data(
+            extracted_content,
+            style_description
+        )
+        _store_cached_transform(cache_path, transformed_content)
+    
+    if SAVE_INTERMEDIATE_JSON:
+        _save_json(work_dir / "extracted_content.json", extracted_content)
+        _save_json(work_dir / "transformed_content.json", transformed_content)
+    
+    # Apply transformations
+    replace_text_and_colors_data(
+        input_path,
+        transformed_content,
+        output_path
+    )
+
+def _transform_cache_key(extracted_content: Dict, style_description: str) -> str:
+    """Hash the inputs the transformation agent actually sees"""
+    payload = orjson.dumps([extracted_content['texts'], extracted_content['colors'], style_description])
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def _load_cached_transform(cache_path: Path) -> Optional[Dict]:
+    """Return a cached transformation if present and not expired"""
+    try:
+        with open(cache_path, 'rb') as f:
+            if time.time() - os.fstat(f.fileno()).st_mtime > TRANSFORM_CACHE_TTL:
+                return None
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def _store_cached_transform(cache_path: Path, transformed_content: Dict) -> None:
+    """Cache a transformation unless any part of it is a fallback result"""
+    # A failed batch or palette call would otherwise be replayed for the TTL
+    if transformed_content.get('used_fallback'):
+        return
+    if not any(
+        item['original'] != item['transformed']
+        for item in transformed_content['text_transformations']
+    ):
+        return
+    # Write then rename so concurrent workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(transformed_content))
+    os.replace(tmp_path, cache_path)
+
+def _save_json(path: Path, data: Dict) -> None:
+    """Write an intermediate pipeline result for debugging"""
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
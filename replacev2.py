@@ -1,134 +1,250 @@
-import json
-import xml.etree.ElementTree as ET
+import orjson
+import re
+from functools import lru_cache
+import xml.sax
+from xml.sax.saxutils import XMLGenerator
 import os
 
+WP_META_VALUE = ('http://wordpress.org/export/1.2/', 'meta_value')
+# Elements whose text can hold page content; other text and all attributes
+# (category slugs, guid flags and the like) are copied through untouched
+TEXT_ELEMENTS = frozenset((
+    (None, 'title'),
+    ('http://purl.org/rss/1.0/modules/content/', 'encoded'),
+    ('http://wordpress.org/export/1.2/excerpt/', 'encoded'),
+    WP_META_VALUE
+))
+
+# Background color keys to preserve
+BG_KEYS = frozenset((
+    'background_color',
+    'background_overlay_color',
+    '_background_color',
+    '_background_background',
+    'background_overlay_background'
+))
+
+@lru_cache(maxsize=4096)
+def is_background_key(setting_key):
+    """Whether a setting key is background-related (cached; keys repeat on every element)"""
+    setting_key = setting_key.lower()
+    return 'background' in setting_key or 'bg_' in setting_key
+
+def _element_stack(elementor_data):
+    """Top-level elements as a stack whose next pop() is the first element"""
+    if isinstance(elementor_data, list):
+        return elementor_data[::-1]
+    return [elementor_data]
+
 def scan_background_colors(elementor_data):
-    """Scan and store original background colors"""
+    """Scan and store original background colors as {(element_id, key): value}"""
     bg_colors = {}
+    # Explicit stack instead of recursion; children are pushed in reverse so
+    # elements are still visited in document order
+    stack = _element_stack(elementor_data)
     
-    def scan_element(element):
-        if isinstance(element, dict):
-            if 'id' in element and 'settings' in element:
-                element_id = element['id']
-                settings = element['settings']
-                
-                # Background color keys to preserve
-                bg_keys = [
-                    'background_color',
-                    'background_overlay_color',
-                    '_background_color',
-                    '_background_background',
-                    'background_overlay_background'
-                ]
-                
-                # Store original colors
-                for key in bg_keys:
-                    if key in settings and settings[key]:
-                        if element_id not in bg_colors:
-                            bg_colors[element_id] = {}
-                        bg_colors[element_id][key] = settings[key]
-            
-            if 'elements' in element:
-                for child in element['elements']:
-                    scan_element(child)
-    
-    if isinstance(elementor_data, list):
-        for item in elementor_data:
-            scan_element(item)
-    else:
-        scan_element(elementor_data)
+    while stack:
+        element = stack.pop()
+        if type(element) is not dict:
+            continue
+        settings = element.get('settings')
+        element_id = element.get('id')
+        if element_id is not None and type(settings) is dict:
+            # Store original colors; the C-level intersection is empty for
+            # most elements, so they cost a single set operation
+            for key in BG_KEYS & settings.keys():
+                if settings[key]:
+                    bg_colors[element_id, key] = settings[key]
+        
+        children = element.get('elements')
+        if children and type(children) is list:
+            stack.extend(reversed(children))
     
     return bg_colors
 
-def process_elementor_data(elementor_data, color_map, original_bg_colors):
+def process_elementor_data(elementor_data, color_map, original_bg_colors, replace_color=None):
     """Process colors while preserving backgrounds"""
+    if replace_color is None:
+        replace_color = build_replacer(color_map.items())
+    
+    stack = _element_stack(elementor_data)
     
-    def process_element(element):
-        if isinstance(element, dict):
-            if 'settings' in element and 'id' in element:
-                settings = element['settings']
-                element_id = element['id']
-                
-                # Restore original background colors
-                if element_id in original_bg_colors:
-                    for key, value in original_bg_colors[element_id].items():
+    while stack:
+        element = stack.pop()
+        if type(element) is not dict:
+            continue
+        settings = element.get('settings')
+        element_id = element.get('id')
+        # Only dict settings hold colors; Elementor writes [] for empty ones
+        if element_id is not None and type(settings) is dict:
+            # Restore original background colors
+            if original_bg_colors:
+                for key in BG_KEYS:
+                    value = original_bg_colors.get((element_id, key))
+                    if value is not None:
                         settings[key] = value
-                
-                # Replace other colors in settings
-                if isinstance(settings, dict):  # Add type check
-                    for setting_key in list(settings.keys()):  # Convert to list to avoid runtime modification
-                        value = settings[setting_key]
-                        if isinstance(value, str):
-                            # Skip background-related keys
-                            if not any(bg in setting_key.lower() for bg in ['background', 'bg_']):
-                                for orig_color in color_map:
-                                    if orig_color in value:
-                                        settings[setting_key] = value.replace(orig_color, color_map[orig_color])
             
-            # Process nested elements
-            if 'elements' in element and isinstance(element['elements'], list):
-                for child in element['elements']:
-                    process_element(child)
-                    
-    # Handle both list and dict input
-    if isinstance(elementor_data, list):
-        for item in elementor_data:
-            process_element(item)
-    else:
-        process_element(elementor_data)
+            # Replace other colors in settings, skipping background-related
+            # keys; reassigning existing keys is safe while iterating items()
+            if replace_color:
+                for setting_key, value in settings.items():
+                    if type(value) is str and not is_background_key(setting_key):
+                        new_value = replace_color(value)
+                        if new_value is not value:
+                            settings[setting_key] = new_value
+        
+        # Process nested elements
+        children = element.get('elements')
+        if children and type(children) is list:
+            stack.extend(reversed(children))
     
     return elementor_data
 
+def build_replacer(pairs):
+    """
+    Compile (original, replacement) pairs into one function that rewrites a
+    string in a single regex pass, or return None when there is nothing to do
+    """
+    mapping = {}
+    for original, replacement in pairs:
+        if original:
+            mapping.setdefault(original, replacement)
+    if not mapping:
+        return None
+
+    # Longest first, so a string is never shadowed by one of its own prefixes
+    pattern = re.compile('|'.join(
+        re.escape(original) for original in sorted(mapping, key=len, reverse=True)
+    ))
+    lookup = mapping.__getitem__
+
+    def replace(value):
+        return pattern.sub(lambda match: lookup(match.group(0)), value)
+
+    # When every original starts with the same character (e.g. '#' for hex
+    # colors), strings without it cannot match and skip the regex entirely
+    first_chars = {original[0] for original in mapping}
+    if len(first_chars) == 1:
+        marker = first_chars.pop()
+        substitute = replace
+
+        def replace(value):
+            if marker not in value:
+                return value
+            return substitute(value)
+
+    return replace
+
+class ReplacementWriter(xml.sax.handler.ContentHandler):
+    """Rewrite texts and Elementor colors while streaming the export to a file"""
+
+    def __init__(self, output_file, replace_text, color_map):
+        super().__init__()
+        self.writer = XMLGenerator(output_file, encoding='utf-8', short_empty_elements=True)
+        self.replace_text = replace_text
+        self.color_map = color_map
+        # Compiled once here rather than for every meta value
+        self.replace_color = build_replacer(color_map.items())
+        # Identical templates (headers, footers, reused blocks) recur across
+        # posts; rewrite each distinct meta value once
+        self.rewrite_meta_value = lru_cache(maxsize=128)(self._rewrite_meta_value)
+        self._chars = []
+
+    def _rewrite_meta_value(self, text):
+        """Rewrite colors in an Elementor meta value, or return it unchanged"""
+        if '[{' not in text:
+            return text
+        try:
+            elementor_data = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            return text
+        # Backgrounds are scanned per page, so the blob is parsed once
+        modified_data = process_elementor_data(
+            elementor_data, self.color_map,
+            scan_background_colors(elementor_data), self.replace_color
+        )
+        return orjson.dumps(modified_data).decode('utf-8')
+
+    def _flush(self, element_name=None):
+        """
+        Write the pending character run; element_name is set when the run is
+        the full text of a closing element
+        """
+        if not self._chars:
+            return
+        text = ''.join(self._chars)
+        self._chars = []
+        if element_name not in TEXT_ELEMENTS:
+            self.writer.characters(text)
+            return
+        if self.replace_text:
+            text = self.replace_text(text)
+        if element_name == WP_META_VALUE:
+            text = self.rewrite_meta_value(text)
+        self.writer.characters(text)
+
+    def startDocument(self):
+        self.writer.startDocument()
+
+    def endDocument(self):
+        self._flush()
+        self.writer.endDocument()
+
+    def startPrefixMapping(self, prefix, uri):
+        self._flush()
+        self.writer.startPrefixMapping(prefix, uri)
+
+    def endPrefixMapping(self, prefix):
+        self.writer.endPrefixMapping(prefix)
+
+    def startElementNS(self, name, qname, attrs):
+        self._flush()
+        self.writer.startElementNS(name, qname, attrs)
+
+    def endElementNS(self, name, qname):
+        self._flush(name)
+        self.writer.endElementNS(name, qname)
+
+    def characters(self, content):
+        self._chars.append(content)
+
+    def processingInstruction(self, target, data):
+        self._flush()
+        self.writer.processingInstruction(target, data)
+
+def parse_export(xml_file_path, handler):
+    """Stream a WordPress export through a namespace-aware SAX handler"""
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setContentHandler(handler)
+    parser.parse(xml_file_path)
+
 def replace_text_and_colors(xml_file_path, json_file_path, output_file_path):
-    ET.register_namespace('wp', 'http://wordpress.org/export/1.2/')
-    tree = ET.parse(xml_file_path)
-    root = tree.getroot()
-    
-    with open(json_file_path, 'r', encoding='utf-8') as json_file:
-        data = json.load(json_file)
+    with open(json_file_path, 'rb') as json_file:
+        data = orjson.loads(json_file.read())
     
+    replace_text_and_colors_data(xml_file_path, data, output_file_path)
+
+def replace_text_and_colors_data(xml_file_path, data, output_file_path):
+    """Apply already-loaded transformation data to the XML export"""
     text_transformations = data.get("text_transformations", [])
     color_map = dict(zip(
         data["color_palette"]["original_colors"],
         data["color_palette"]["new_colors"]
     ))
 
-    # Replace text in the XML (based on your provided method)
-    for transformation in text_transformations:
-        original_text = transformation["original"]
-        transformed_text = transformation["transformed"]
-        for elem in root.iter():
-            if elem.text and original_text in elem.text:
-                elem.text = elem.text.replace(original_text, transformed_text)
-            if elem.tail and original_text in elem.tail:
-                elem.tail = elem.tail.replace(original_text, transformed_text)
-            if elem.attrib:
-                for attr_key, attr_value in elem.attrib.items():
-                    if original_text in attr_value:
-                        elem.attrib[attr_key] = attr_value.replace(original_text, transformed_text)
+    # All text transformations are applied together in one pass per string
+    replace_text = build_replacer(
+        (transformation["original"], transformation["transformed"])
+        for transformation in text_transformations
+    )
 
-    
-    # Store original background colors
-    original_colors = {}
-    for item in root.findall('.//wp:meta_value', {'wp': 'http://wordpress.org/export/1.2/'}):
-        if item.text and '[{' in item.text:
-            try:
-                elementor_data = json.loads(item.text)
-                page_colors = scan_background_colors(elementor_data)
-                original_colors.update(page_colors)
-            except json.JSONDecodeError:
-                continue
-    
-    # Process XML with preserved backgrounds
-    for item in root.findall('.//wp:meta_value', {'wp': 'http://wordpress.org/export/1.2/'}):
-        if item.text and '[{' in item.text:
-            try:
-                elementor_data = json.loads(item.text)
-                modified_data = process_elementor_data(elementor_data, color_map, original_colors)
-                item.text = json.dumps(modified_data)
-            except json.JSONDecodeError:
-                continue
-    
+    # The export is streamed instead of being held in memory: texts and colors
+    # are rewritten as the document is copied to the output
     os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-    tree.write(output_file_path, encoding='utf-8', xml_declaration=True)
-
+    # A 1 MB buffer keeps large exports from being written in many small syscalls
+    with open(output_file_path, 'wb', buffering=1 << 20) as output_file:
+        parse_export(
+            xml_file_path,
+            ReplacementWriter(output_file, replace_text, color_map)
+        )
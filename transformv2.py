@@ -1,15 +1,76 @@
-import json
+import asyncio
+import hashlib
+import httpx
 import openai
+import orjson
+import random
 import re
-from typing import Dict, List
+import time
+from openai import AsyncOpenAI, DefaultAioHttpClient, DefaultHttpxClient, OpenAI
+from typing import Dict, List, Optional, Tuple
 import os
 
+# Texts per GPT request; typical theme strings are short, so bigger batches
+# mean fewer round-trips without getting near the context limit
+TEXT_BATCH_SIZE = 20
+
+# Estimated text tokens per GPT request. The reply echoes each original next
+# to its transformation, so this keeps it well inside max_tokens=4096.
+BATCH_TOKEN_BUDGET = 1500
+
+# Up to this many distinct texts, texts and palette share one request
+FUSED_REQUEST_MAX_TEXTS = TEXT_BATCH_SIZE
+
+# A single GPT request is abandoned (and retried) after 60s; a connection
+# that can't be opened within 5s fails fast instead
+REQUEST_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# Kept-alive connections let successive requests skip the TLS handshake
+CONNECTION_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0)
+
+# Batch API jobs that end in any of these states will not produce more output
+BATCH_FINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+# Patterns used to clean and parse GPT responses, compiled once
+# \" -> ", \\ -> \, and \n (also \\n, as the old chained replaces did) -> newline
+_ESCAPE_RE = re.compile(r'\\(\\?n|["\\])')
+_ESCAPES = {'"': '"', '\\': '\\', 'n': '\n', '\\n': '\n'}
+_STANDALONE_BACKSLASH_RE = re.compile(r'\\(?!["\\/])')
+_REPEATED_QUOTES_RE = re.compile(r'"{2,}')
+_HEX_COLOR_RE = re.compile(r'#[0-9a-fA-F]{3,6}')
+_NEW_COLORS_RE = re.compile(r'NEW COLORS:(.+?)(?===|$)', re.DOTALL)
+_NOTES_RE = re.compile(r'=== NOTES ===(.+?)(?===|$)', re.DOTALL)
+_ORIGINAL_TAIL_RE = re.compile(r'ORIGINAL:.*')
+_SECTION_MARKER_RE = re.compile(r'===.*===')
+
+# Transient API errors that are worth retrying with backoff
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
 class ContentTransformationAgent:
     """Agent responsible for transforming extracted content using GPT-4"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str,
+                 max_requests_per_minute: float = 3500,
+                 max_tokens_per_minute: float = 200000,
+                 max_attempts: int = 5,
+                 cache_dir: Optional[str] = None,
+                 cache_ttl: float = 7 * 24 * 3600):
         self.api_key = api_key
-        openai.api_key = api_key
+        # Sync client for the Batch API path, built on first use and reused
+        self.client = None
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.max_attempts = max_attempts
+        # Per-request GPT responses are cached here when set
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
 
     def transform_content(self, rag_input_path: str, 
                          transformed_output_path: str, 
@@ -19,66 +80,364 @@ class ContentTransformationAgent:
         """
         try:
             # Load extracted content
-            with open(rag_input_path, 'r', encoding='utf-8') as f:
-                extracted_content = json.load(f)
-
-            print(f"Loaded {len(extracted_content['texts'])} texts and {len(extracted_content['colors'])} colors")
-
-            # Transform content in smaller batches to avoid token limits
-            batch_size = 5
-            transformed_texts = []
-            for i in range(0, len(extracted_content['texts']), batch_size):
-                batch_texts = extracted_content['texts'][i:i + batch_size]
-                batch_result = self._generate_transformed_content(
-                    batch_texts,
-                    extracted_content['colors'],
-                    style_description
-                )
-                transformed_texts.extend(batch_result['text_transformations'])
-            
-            # Generate final color palette
-            final_color_result = self._generate_color_palette(
-                extracted_content['colors'],
-                style_description
-            )
+            with open(rag_input_path, 'rb') as f:
+                extracted_content = orjson.loads(f.read())
 
-            transformed_data = {
-                'text_transformations': transformed_texts,
-                'color_palette': final_color_result['color_palette'],
-                'transformation_notes': final_color_result['transformation_notes']
-            }
-
-            # Verify transformations
-            self._verify_transformations(transformed_data, len(extracted_content['texts']), len(extracted_content['colors']))
+            cleaned_transformed_data = self.transform_content_data(extracted_content, style_description)
 
             # Save transformed content with proper formatting
             os.makedirs(os.path.dirname(transformed_output_path), exist_ok=True)
-            with open(transformed_output_path, 'w', encoding='utf-8') as f:
-                # Clean the content before dumping into JSON to remove unwanted escape characters
-                cleaned_transformed_data = self._clean_transformed_data(transformed_data)
-                json.dump(cleaned_transformed_data, f, indent=2, ensure_ascii=False)
+            with open(transformed_output_path, 'wb') as f:
+                f.write(orjson.dumps(cleaned_transformed_data, option=orjson.OPT_INDENT_2))
                 
         except Exception as e:
             print(f"Error in transform_content: {e}")
             raise
 
+    def transform_content_data(self, extracted_content: Dict, style_description: str) -> Dict:
+        """
+        Transform already-loaded extracted content and return the cleaned result
+        """
+        print(f"Loaded {len(extracted_content['texts'])} texts and {len(extracted_content['colors'])} colors")
+
+        # All GPT calls are I/O-bound, so run them concurrently on one event loop
+        transformed_texts, final_color_result, used_fallback = asyncio.run(
+            self._generate_all(extracted_content, style_description)
+        )
+        return self._finish_transformation(extracted_content, transformed_texts, final_color_result, used_fallback)
+
+    def transform_content_batch(self, extracted_content: Dict, style_description: str,
+                                poll_interval: float = 10.0, max_poll_interval: float = 300.0) -> Dict:
+        """
+        Transform content through the OpenAI Batch API.
+
+        Sends the same text-batch and palette requests as transform_content_data
+        and parses them the same way, at half the cost, but completion can take
+        up to 24h, so this suits offline jobs only.
+        """
+        texts = extracted_content['texts']
+        colors = extracted_content['colors']
+        print(f"Loaded {len(texts)} texts and {len(colors)} colors")
+
+        # Repeated strings ("Read more", nav items) are only sent once
+        unique_texts = list(dict.fromkeys(texts))
+        text_batches = {
+            f"texts_{i}": batch_texts
+            for i, batch_texts in enumerate(self._pack_batches(unique_texts))
+        }
+        requests = {
+            custom_id: self._text_request(batch_texts, style_description)
+            for custom_id, batch_texts in text_batches.items()
+        }
+        requests['colors'] = self._color_request(colors, style_description)
+
+        # Requests answered before (live or batch) are not submitted again
+        responses = {}
+        pending = {}
+        for custom_id, body in requests.items():
+            cached = self._load_cached_response(body)
+            if cached is None:
+                pending[custom_id] = body
+            else:
+                responses[custom_id] = cached
+        if pending:
+            if self.client is None:
+                self.client = OpenAI(
+                    api_key=self.api_key,
+                    http_client=DefaultHttpxClient(limits=CONNECTION_LIMITS, timeout=REQUEST_TIMEOUT),
+                    max_retries=5,
+                    timeout=REQUEST_TIMEOUT
+                )
+            responses.update(self._run_batch(pending, poll_interval, max_poll_interval))
+
+        transformed_texts = []
+        used_fallback = False
+        for custom_id, batch_texts in text_batches.items():
+            if custom_id in responses:
+                batch_result = self._parse_text_transformations(responses[custom_id], batch_texts)
+            else:
+                batch_result = self._generate_fallback_content(batch_texts, colors)
+            used_fallback = used_fallback or batch_result['fallback']
+            transformed_texts.extend(batch_result['text_transformations'][:len(batch_texts)])
+        transformed_texts = self._expand_duplicates(texts, unique_texts, transformed_texts)
+
+        if 'colors' in responses:
+            final_color_result = self._color_result(responses['colors'], colors)
+        else:
+            final_color_result = self._fallback_color_palette(colors, "no batch result")
+        used_fallback = used_fallback or final_color_result['fallback']
+
+        return self._finish_transformation(extracted_content, transformed_texts, final_color_result, used_fallback)
+
+    def _run_batch(self, requests: Dict[str, Dict],
+                   poll_interval: float, max_poll_interval: float) -> Dict[str, str]:
+        """Submit chat requests as one batch, wait for it and return message content by custom_id"""
+        payload = b"".join(
+            orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }) + b"\n"
+            for custom_id, body in requests.items()
+        )
+
+        input_file = self.client.files.create(file=("transform_batch.jsonl", payload), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+        # Back off exponentially; batches usually take minutes to hours
+        delay = poll_interval
+        while batch.status not in BATCH_FINAL_STATUSES:
+            time.sleep(delay)
+            delay = min(delay * 2, max_poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+
+        if batch.status != 'completed':
+            print(f"Warning: batch {batch.id} ended with status {batch.status}")
+        if not batch.output_file_id:
+            return {}
+
+        # Failed requests are missing here and fall back per batch
+        responses = {}
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line:
+                continue
+            result = orjson.loads(line)
+            response = result.get('response') or {}
+            if response.get('status_code') == 200:
+                custom_id = result['custom_id']
+                choice = response['body']['choices'][0]
+                responses[custom_id] = choice['message']['content']
+                self._store_cached_response(requests[custom_id], choice['message']['content'], choice.get('finish_reason'))
+        return responses
+
+    def _finish_transformation(self, extracted_content: Dict, transformed_texts: List[Dict],
+                               final_color_result: Dict, used_fallback: bool) -> Dict:
+        """Assemble, verify and clean the transformation result"""
+        transformed_data = {
+            'text_transformations': transformed_texts,
+            'color_palette': final_color_result['color_palette'],
+            'transformation_notes': final_color_result['transformation_notes'],
+            # True when any text batch or the palette kept original content
+            # because GPT failed; such results should not be cached
+            'used_fallback': used_fallback
+        }
+
+        # Verify transformations
+        self._verify_transformations(transformed_data, len(extracted_content['texts']), len(extracted_content['colors']))
+
+        # Clean the content to remove unwanted escape characters
+        return self._clean_transformed_data(transformed_data)
+
+    async def _generate_all(self, extracted_content: Dict, style_description: str) -> Tuple[List[Dict], Dict, bool]:
+        """Request every text batch and the color palette concurrently"""
+        texts = extracted_content['texts']
+        colors = extracted_content['colors']
+
+        # One client per run; its connection pool is bound to this event loop.
+        # The aiohttp transport holds up better than httpx under wide fan-out.
+        # Retries are handled by _call_with_limits, so the SDK's own are off.
+        async with AsyncOpenAI(
+            api_key=self.api_key,
+            http_client=DefaultAioHttpClient(limits=CONNECTION_LIMITS, timeout=REQUEST_TIMEOUT),
+            max_retries=0,
+            timeout=REQUEST_TIMEOUT
+        ) as self.aclient:
+            # Request/token budget starts full and refills continuously
+            self._limit_lock = asyncio.Lock()
+            self._available_requests = self.max_requests_per_minute
+            self._available_tokens = self.max_tokens_per_minute
+            self._last_refill = time.monotonic()
+
+            # Repeated strings ("Read more", nav items) and colors are only sent once
+            unique_texts = list(dict.fromkeys(texts))
+            unique_colors = list(dict.fromkeys(colors))
+
+            # Transform content in smaller batches to avoid token limits
+            batches = self._pack_batches(unique_texts)
+
+            # Small pages: one combined request saves the palette round-trip,
+            # as long as texts and colors together fit one reply
+            fused_tokens = (
+                sum(self._estimate_tokens(text) for text in unique_texts)
+                # Hex codes tokenise into ~2-character pieces
+                + sum(len(color) // 2 + 1 for color in unique_colors)
+            )
+            results = None
+            if (len(batches) == 1 and len(unique_texts) <= FUSED_REQUEST_MAX_TEXTS
+                    and fused_tokens <= BATCH_TOKEN_BUDGET):
+                try:
+                    results = list(await self._generate_fused(unique_texts, unique_colors, style_description))
+                except Exception as e:
+                    print(f"Error in combined generation, using separate requests: {e}")
+
+            if results is None:
+                tasks = [
+                    self._generate_transformed_content(batch_texts, unique_colors, style_description)
+                    for batch_texts in batches
+                ]
+                tasks.append(self._generate_color_palette(unique_colors, style_description))
+                results = await asyncio.gather(*tasks)
+
+        # gather keeps task order, so batches flatten back into text order;
+        # extra items from a batch would shift the mapping, so trim them
+        transformed_unique = [
+            item
+            for batch_texts, batch_result in zip(batches, results)
+            for item in batch_result['text_transformations'][:len(batch_texts)]
+        ]
+        return (
+            self._expand_duplicates(texts, unique_texts, transformed_unique),
+            self._expand_palette(colors, unique_colors, results[-1]),
+            any(result['fallback'] for result in results)
+        )
+
+    def _pack_batches(self, texts: List[str]) -> List[List[str]]:
+        """Group texts in order into batches capped by count and estimated tokens"""
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = self._estimate_tokens(text)
+            if batch and (len(batch) == TEXT_BATCH_SIZE or batch_tokens + tokens > BATCH_TOKEN_BUDGET):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _estimate_tokens(self, text: str) -> int:
+        """Rough token count: ~4 characters per token, as in the rate limiter"""
+        return len(text) // 4 + 1
+
+    def _expand_duplicates(self, texts: List[str], unique_texts: List[str], transformed_unique: List[Dict]) -> List[Dict]:
+        """Map per-unique-text results back onto every original occurrence"""
+        by_text = dict(zip(unique_texts, transformed_unique))
+        return [by_text[text] for text in texts]
+
+    def _expand_palette(self, colors: List[str], unique_colors: List[str], color_result: Dict) -> Dict:
+        """Map a palette generated for the unique colors back onto the full color list"""
+        by_color = dict(zip(unique_colors, color_result['color_palette']['new_colors']))
+        return {
+            **color_result,
+            'color_palette': {
+                'original_colors': colors,
+                'new_colors': [by_color[color] for color in colors]
+            }
+        }
+
+    async def _complete(self, body: Dict) -> str:
+        """Return the message content for a chat request, from the cache when possible"""
+        cached = self._load_cached_response(body)
+        if cached is not None:
+            return cached
+
+        response = await self._call_with_limits(body)
+        choice = response.choices[0]
+        self._store_cached_response(body, choice.message.content, choice.finish_reason)
+        return choice.message.content
+
+    def _load_cached_response(self, body: Dict) -> Optional[str]:
+        """Return a cached response for the request if present and not expired"""
+        cache_path = self._response_cache_path(body)
+        if not cache_path:
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > self.cache_ttl:
+                    return None
+                return f.read().decode('utf-8')
+        except OSError:
+            return None
+
+    def _store_cached_response(self, body: Dict, response_text: Optional[str], finish_reason: Optional[str]) -> None:
+        """Cache a response only if it finished normally and is the requested JSON"""
+        cache_path = self._response_cache_path(body)
+        if not cache_path or finish_reason != 'stop' or not response_text:
+            return
+        # Truncated or garbled replies would otherwise replay as fallbacks
+        try:
+            if type(orjson.loads(response_text)) is not dict:
+                return
+        except orjson.JSONDecodeError:
+            return
+        # Write then rename so concurrent workers never read a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(response_text.encode('utf-8'))
+        os.replace(tmp_path, cache_path)
+
+    def _response_cache_path(self, body: Dict) -> Optional[str]:
+        """Cache file for a request; the body covers model, prompt, style and texts"""
+        if not self.cache_dir:
+            return None
+        key = hashlib.blake2b(orjson.dumps(body, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    async def _call_with_limits(self, body: Dict):
+        """Send a chat completion within the RPM/TPM budget, retrying transient errors"""
+        # Rough prompt size (~4 characters per token) plus the completion
+        # allowance, which OpenAI's limiter also reserves up front
+        tokens = min(
+            len(orjson.dumps(body['messages'])) // 4 + body.get('max_tokens', 0),
+            self.max_tokens_per_minute
+        )
+        for attempt in range(1, self.max_attempts + 1):
+            await self._acquire_capacity(tokens)
+            try:
+                return await self.aclient.chat.completions.create(**body)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_attempts:
+                    raise
+                print(f"Retrying GPT request after error (attempt {attempt}): {e}")
+                await asyncio.sleep(2 ** attempt + random.random())
+
+    async def _acquire_capacity(self, tokens: int) -> None:
+        """Wait until one request and the given tokens fit in the per-minute budget"""
+        async with self._limit_lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self._last_refill
+                self._last_refill = now
+                self._available_requests = min(
+                    self.max_requests_per_minute,
+                    self._available_requests + elapsed * self.max_requests_per_minute / 60
+                )
+                self._available_tokens = min(
+                    self.max_tokens_per_minute,
+                    self._available_tokens + elapsed * self.max_tokens_per_minute / 60
+                )
+                if self._available_requests >= 1 and self._available_tokens >= tokens:
+                    self._available_requests -= 1
+                    self._available_tokens -= tokens
+                    return
+                await asyncio.sleep(0.1)
+
     def _clean_transformed_data(self, data: Dict) -> Dict:
         """Clean transformed data to remove unwanted escape characters."""
-        cleaned_data = data.copy()
-        
-        # Clean text transformations
-        for item in cleaned_data['text_transformations']:
-            # Clean both original and transformed texts
-            if isinstance(item.get('original'), str):
-                item['original'] = self._remove_escape_characters(item['original'])
-            if isinstance(item.get('transformed'), str):
-                item['transformed'] = self._remove_escape_characters(item['transformed'])
-
-        # Clean color palette notes
-        if isinstance(cleaned_data.get('transformation_notes'), str):
-            cleaned_data['transformation_notes'] = self._remove_escape_characters(cleaned_data['transformation_notes'])
+        clean = self._remove_escape_characters
+        notes = data.get('transformation_notes')
         
-        return cleaned_data
+        # Build new items rather than mutating the caller's dicts
+        return {
+            **data,
+            'text_transformations': [
+                {
+                    **item,
+                    'original': clean(item['original']) if isinstance(item.get('original'), str) else item.get('original'),
+                    'transformed': clean(item['transformed']) if isinstance(item.get('transformed'), str) else item.get('transformed')
+                }
+                for item in data['text_transformations']
+            ],
+            'transformation_notes': clean(notes) if isinstance(notes, str) else notes
+        }
     
     def _remove_escape_characters(self, text: str) -> str:
         """Remove escape characters and clean up text.
@@ -96,66 +455,73 @@ class ContentTransformationAgent:
         if text.startswith('"') and text.endswith('"'):
             # Remove outer quotes
             text = text[1:-1]
+
+        # Most labels and headings have nothing left to clean
+        if '\\' not in text and '""' not in text:
+            return text
             
-        # Remove unnecessary backslashes before quotes
-        text = text.replace(r'\"', '"')
-        text = text.replace(r'\\', '\\')
+        # Unescape quotes, backslashes and newlines in a single pass
+        text = _ESCAPE_RE.sub(lambda m: _ESCAPES[m.group(1)], text)
         
         # Remove any remaining unnecessary backslashes
-        text = text.replace(r'\n', '\n')  # Preserve actual newlines
-        text = re.sub(r'\\(?!["\\/])', '', text)  # Remove standalone backslashes
+        text = _STANDALONE_BACKSLASH_RE.sub('', text)  # Remove standalone backslashes
         
         # Clean up any doubled-up quotes
-        text = re.sub(r'"{2,}', '"', text)
+        text = _REPEATED_QUOTES_RE.sub('"', text)
         
         return text
 
 
-    def _generate_transformed_content(self, 
+    async def _generate_transformed_content(self, 
                                     current_texts: List[str],
                                     current_colors: List[str],
                                     style_description: str) -> Dict:
         """Generate new content using GPT-4 with improved prompt"""
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": """You are a WordPress theme content transformer. Transform each text to match the requested style while:
-                    1. Preserving the core meaning and key information
-                    2. Maintaining appropriate length and structure
-                    3. Ensuring professional and coherent output
-                    4. Never returning text unchanged unless explicitly requested
-                    5. Make the content length close to the given not much bigger or smaller
-                    6. You are taking the original text and this for the content for last desing needs your mission os to transform this content to new one based on user needs
-                    Format each transformation exactly as: 'ORIGINAL: [text] 
-                    NEW: [transformed text]'"""
-                },
-                {
-                    "role": "user",
-                    "content": f"""Transform these WordPress theme texts to match this user needs: {style_description}
-                    so you change the each original text to new content based on user style
-
-                    Original texts:
-                    {json.dumps(current_texts, indent=2)}
-
-                    Required format for each text:
-                    ORIGINAL: [original text]
-                    NEW: [transformed text]"""
-                }
-            ]
-
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo-0125",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=4096
+            response_text = await self._complete(
+                self._text_request(current_texts, style_description)
             )
             
-            return self._parse_text_transformations(response.choices[0].message.content, current_texts)
+            return self._parse_text_transformations(response_text, current_texts)
             
         except Exception as e:
             print(f"Error in content generation: {e}")
             return self._generate_fallback_content(current_texts, current_colors)
+
+    def _text_request(self, current_texts: List[str], style_description: str) -> Dict:
+        """Build the chat completion request for one batch of texts"""
+        messages = [
+            {
+                "role": "system",
+                "content": """You are a WordPress theme content transformer. Transform each text to match the requested style while:
+                1. Preserving the core meaning and key information
+                2. Maintaining appropriate length and structure
+                3. Ensuring professional and coherent output
+                4. Never returning text unchanged unless explicitly requested
+                5. Make the content length close to the given not much bigger or smaller
+                6. You are taking the original text and this for the content for last desing needs your mission os to transform this content to new one based on user needs
+                Respond with a JSON object of the form:
+                {"transformations": [{"original": "[original text]", "transformed": "[transformed text]"}]}"""
+            },
+            {
+                "role": "user",
+                "content": f"""Transform these WordPress theme texts to match this user needs: {style_description}
+                so you change the each original text to new content based on user style
+
+                Original texts:
+                {orjson.dumps(current_texts, option=orjson.OPT_INDENT_2).decode()}
+
+                Return one entry per text, in the same order, copying each original text exactly:
+                {{"transformations": [{{"original": "[original text]", "transformed": "[transformed text]"}}]}}"""
+            }
+        ]
+        return {
+            "model": "gpt-3.5-turbo-0125",
+            "messages": messages,
+            "response_format": {"type": "json_object"},
+            "temperature": 0.7,
+            "max_tokens": 4096
+        }
     
     def _generate_fallback_content(self, current_texts: List[str], current_colors: List[str]) -> Dict:
 
@@ -168,86 +534,180 @@ class ContentTransformationAgent:
             }
             for text in current_texts
         ],
-        "transformation_notes": "Fallback content generated due to transformation error"
+        "transformation_notes": "Fallback content generated due to transformation error",
+        "fallback": True
     } 
 
 
-    def _generate_color_palette(self, current_colors: List[str], style_description: str) -> Dict:
+    async def _generate_color_palette(self, current_colors: List[str], style_description: str) -> Dict:
         """Generate new color palette using GPT-4"""
         try:
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo-0125",
-                messages=[{
-                    "role": "system",
-                    "content": """You are a color palette generator for WordPress themes.
-                    Generate new hex colors that match the requested style.
-                    Always provide completely different colors than the original.
-                    Return ONLY the new colors in the exact same format as the input, preserving case.
-                    """
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                    Generate a new color palette matching this style: {style_description}
-                    Replace these colors with new ones that match the style:
-                    {json.dumps(current_colors, indent=2)}
-                    
-                    Return only the list of new colors in the same format, maintaining letter case.
-                    Example format:
-                    === COLOR PALETTE ===
-                    NEW COLORS: [list of new hex codes]
-                    === NOTES ===
-                    [Explain your color choices]
-                    """
-                }],
-                temperature=0.7
+            response_text = await self._complete(
+                self._color_request(current_colors, style_description)
             )
             
-            # Parse the GPT response
-            response_text = response.choices[0].message.content
-            
-            # Extract new colors
-            color_section = re.search(r'NEW COLORS:(.+?)(?===|$)', response_text, re.DOTALL)
-            new_colors = []
-            if color_section:
-                # Extract hex colors while preserving their original case
-                new_colors = re.findall(r'#[0-9a-fA-F]{3,6}', color_section.group(1))
-            
-            # Extract notes
-            notes_section = re.search(r'=== NOTES ===(.+?)(?===|$)', response_text, re.DOTALL)
-            transformation_notes = ""
-            if notes_section:
-                transformation_notes = notes_section.group(1).strip()
-            
-            # Ensure we have enough colors
-            while len(new_colors) < len(current_colors):
-                # If we don't have enough colors, copy from the ones we have
-                new_colors.append(new_colors[len(new_colors) % len(new_colors)] if new_colors else "#000000")
-            
-            return {
-                "color_palette": {
-                    "original_colors": current_colors,
-                    "new_colors": new_colors[:len(current_colors)]  # Trim to match original length
-                },
-                "transformation_notes": transformation_notes or "Color transformation complete"
-            }
+            return self._color_result(response_text, current_colors)
             
         except Exception as e:
             print(f"Error in color generation: {e}")
-            return {
-                "color_palette": {
-                    "original_colors": current_colors,
-                    "new_colors": current_colors  # Return original colors as fallback
-                },
-                "transformation_notes": f"Error in color transformation: {str(e)}"
+            return self._fallback_color_palette(current_colors, str(e))
+
+    def _color_result(self, response_text: str, current_colors: List[str]) -> Dict:
+        """Build the palette result from a GPT response, one new color per original"""
+        # Parse the GPT response
+        new_colors, transformation_notes = self._read_color_response(response_text)
+        
+        # Ensure we have enough colors by cycling through the ones we have
+        fallback = len(new_colors) < len(current_colors)
+        if new_colors:
+            need = len(current_colors) - len(new_colors)
+            if need > 0:
+                new_colors.extend((new_colors * (need // len(new_colors) + 1))[:need])
+        else:
+            new_colors = ["#000000"] * len(current_colors)
+        
+        return {
+            "color_palette": {
+                "original_colors": current_colors,
+                "new_colors": new_colors[:len(current_colors)]  # Trim to match original length
+            },
+            "transformation_notes": transformation_notes or "Color transformation complete",
+            "fallback": fallback
+        }
+
+    async def _generate_fused(self, current_texts: List[str], current_colors: List[str],
+                              style_description: str) -> Tuple[Dict, Dict]:
+        """Transform a single batch of texts and the color palette in one request"""
+        response_text = await self._complete(
+            self._fused_request(current_texts, current_colors, style_description)
+        )
+        # A truncated or partial reply must not be padded into a fallback here;
+        # raising lets the caller send the separate text and palette requests
+        data = orjson.loads(response_text)
+        if (type(data) is not dict
+                or type(data.get('transformations')) is not list
+                or type(data.get('new_colors')) is not list
+                or len(data['transformations']) < len(current_texts)
+                or len(data['new_colors']) < len(current_colors)):
+            raise ValueError("Combined response is missing texts or colors")
+        # The combined JSON carries the keys both parsers look for
+        return (
+            self._parse_text_transformations(response_text, current_texts),
+            self._color_result(response_text, current_colors)
+        )
+
+    def _fused_request(self, current_texts: List[str], current_colors: List[str], style_description: str) -> Dict:
+        """Build one chat completion request covering texts and the color palette"""
+        messages = [
+            {
+                "role": "system",
+                "content": """You are a WordPress theme content transformer and color palette generator.
+                Transform each text to match the requested style while:
+                1. Preserving the core meaning and key information
+                2. Maintaining appropriate length and structure
+                3. Ensuring professional and coherent output
+                4. Never returning text unchanged unless explicitly requested
+                5. Make the content length close to the given not much bigger or smaller
+                Also generate new hex colors that match the requested style, completely different
+                from the original ones, in the same format and letter case as the input.
+                Respond with a JSON object of the form:
+                {"transformations": [{"original": "[original text]", "transformed": "[transformed text]"}],
+                 "new_colors": ["[list of new hex codes]"], "notes": "[Explain your color choices]"}"""
+            },
+            {
+                "role": "user",
+                "content": f"""Transform these WordPress theme texts and colors to match this user needs: {style_description}
+
+                Original texts:
+                {orjson.dumps(current_texts, option=orjson.OPT_INDENT_2).decode()}
+
+                Original colors:
+                {orjson.dumps(current_colors, option=orjson.OPT_INDENT_2).decode()}
+
+                Return one transformation per text and one new color per original color, in the same order,
+                copying each original text exactly."""
             }
+        ]
+        return {
+            "model": "gpt-3.5-turbo-0125",
+            "messages": messages,
+            "response_format": {"type": "json_object"},
+            "temperature": 0.7,
+            "max_tokens": 4096
+        }
+
+    def _color_request(self, current_colors: List[str], style_description: str) -> Dict:
+        """Build the chat completion request for the color palette"""
+        return {
+            "model": "gpt-3.5-turbo-0125",
+            "messages": [{
+                "role": "system",
+                "content": """You are a color palette generator for WordPress themes.
+                Generate new hex colors that match the requested style.
+                Always provide completely different colors than the original.
+                Return ONLY the new colors in the exact same format as the input, preserving case.
+                """
+            },
+            {
+                "role": "user",
+                "content": f"""
+                Generate a new color palette matching this style: {style_description}
+                Replace these colors with new ones that match the style:
+                {orjson.dumps(current_colors, option=orjson.OPT_INDENT_2).decode()}
+                
+                Return one new color per original color, in the same order, maintaining letter case.
+                Respond with a JSON object of the form:
+                {{"new_colors": ["[list of new hex codes]"], "notes": "[Explain your color choices]"}}
+                """
+            }],
+            "response_format": {"type": "json_object"},
+            "temperature": 0.7
+        }
+
+    def _fallback_color_palette(self, current_colors: List[str], reason: str) -> Dict:
+        """Keep the original colors when the palette could not be generated"""
+        return {
+            "color_palette": {
+                "original_colors": current_colors,
+                "new_colors": current_colors  # Return original colors as fallback
+            },
+            "transformation_notes": f"Error in color transformation: {reason}",
+            "fallback": True
+        }
 
     def _parse_text_transformations(self, response_text: str, original_texts: List[str]) -> Dict:
         """Parse GPT response text into structured format"""
+        try:
+            text_transformations = [
+                {"original": item['original'], "transformed": item['transformed']}
+                for item in orjson.loads(response_text)['transformations']
+            ]
+        except (ValueError, KeyError, TypeError):
+            # Not the requested JSON; try the older ORIGINAL:/NEW: text format
+            text_transformations = self._parse_marked_transformations(response_text)
+        
+        # Ensure we have a transformation for each original text
+        fallback = len(text_transformations) < len(original_texts)
+        if fallback:
+            print(f"Warning: Missing transformations. Got {len(text_transformations)}, expected {len(original_texts)}")
+            for text in original_texts[len(text_transformations):]:
+                text_transformations.append({
+                    "original": text,
+                    "transformed": text
+                })
+        
+        return {
+            "text_transformations": text_transformations,
+            "transformation_notes": "Text transformations completed",
+            "fallback": fallback
+        }
+
+    def _parse_marked_transformations(self, response_text: str) -> List[Dict]:
+        """Parse 'ORIGINAL: ... NEW: ...' blocks from a free-form response"""
         text_transformations = []
         
         # Split into individual transformations
-        transformations = re.split(r'ORIGINAL:', response_text)[1:]  # Skip first split
+        transformations = response_text.split('ORIGINAL:')[1:]  # Skip first split
         
         for i, trans in enumerate(transformations):
             parts = trans.split('NEW:', 1)
@@ -256,46 +716,22 @@ class ContentTransformationAgent:
                 transformed = parts[1].strip()
                 
                 # Clean up any remaining formatting
-                transformed = re.sub(r'ORIGINAL:.*', '', transformed).strip()
-                transformed = re.sub(r'===.*===', '', transformed).strip()
+                transformed = _ORIGINAL_TAIL_RE.sub('', transformed).strip()
+                transformed = _SECTION_MARKER_RE.sub('', transformed).strip()
                 
                 text_transformations.append({
                     "original": original,
                     "transformed": transformed
                 })
         
-        # Ensure we have a transformation for each original text
-        if len(text_transformations) < len(original_texts):
-            print(f"Warning: Missing transformations. Got {len(text_transformations)}, expected {len(original_texts)}")
-            for text in original_texts[len(text_transformations):]:
-                text_transformations.append({
-                    "original": text,
-                    "transformed": text
-                })
-        
-        return {
-            "text_transformations": text_transformations,
-            "transformation_notes": "Text transformations completed"
-        }
+        return text_transformations
 
     def _parse_color_palette(self, response_text: str, original_colors: List[str]) -> Dict:
         """Parse color palette response"""
-        new_colors = []
-        transformation_notes = ""
-        
-        # Extract new colors
-        color_section = re.search(r'NEW COLORS:(.+?)(?===|$)', response_text, re.DOTALL)
-        if color_section:
-            new_colors = re.findall(r'#[0-9a-fA-F]{3,6}', color_section.group(1))
-        
-        # Extract notes
-        notes_section = re.search(r'=== NOTES ===(.+?)(?===|$)', response_text, re.DOTALL)
-        if notes_section:
-            transformation_notes = notes_section.group(1).strip()
+        new_colors, transformation_notes = self._read_color_response(response_text)
         
-        # Ensure we have enough colors
-        while len(new_colors) < len(original_colors):
-            new_colors.append(original_colors[len(new_colors)])
+        # Ensure we have enough colors; unmatched originals stay as they are
+        new_colors.extend(original_colors[len(new_colors):])
         
         return {
             "color_palette": {
@@ -305,6 +741,32 @@ class ContentTransformationAgent:
             "transformation_notes": transformation_notes or "Color transformation complete"
         }
 
+    def _read_color_response(self, response_text: str) -> Tuple[List[str], str]:
+        """Return the new colors and notes from a palette response"""
+        try:
+            data = orjson.loads(response_text)
+            new_colors = [
+                color for color in data['new_colors']
+                if isinstance(color, str) and _HEX_COLOR_RE.fullmatch(color)
+            ]
+            notes = data.get('notes')
+            return new_colors, notes.strip() if isinstance(notes, str) else ""
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+        # Not the requested JSON; fall back to the section markers
+        new_colors = []
+        color_section = _NEW_COLORS_RE.search(response_text)
+        if color_section:
+            # Extract hex colors while preserving their original case
+            new_colors = _HEX_COLOR_RE.findall(color_section.group(1))
+        
+        transformation_notes = ""
+        notes_section = _NOTES_RE.search(response_text)
+        if notes_section:
+            transformation_notes = notes_section.group(1).strip()
+        return new_colors, transformation_notes
+
     def _verify_transformations(self, transformed_data: Dict, original_text_count: int, original_color_count: int) -> None:
         """Verify and print transformation results"""
         text_count = len(transformed_data['text_transformations'])